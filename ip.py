@@ -1,328 +1,810 @@
 import socket
+import re
+import ipaddress
+import concurrent.futures
 import requests
-import geoip2.database
+from requests.adapters import HTTPAdapter
+import maxminddb
 import os
 import sys
+import shutil
+import json
+import orjson
 from dotenv import load_dotenv
 import datetime
+import time
+import logging
+import logging.handlers
+import queue
+import threading
+import collections
+import random
+from dataclasses import dataclass
+
+# 不含前导零的标准点分IPv4
+_DOTTED_IPV4_RE = re.compile(r'(?:0|[1-9]\d{0,2})(?:\.(?:0|[1-9]\d{0,2})){3}')
+# 宽松的四段数字IPv4，允许前导零
+_LOOSE_IPV4_RE = re.compile(r'(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})')
+# 从URL返回的原始字节中提取IPv4候选项，合法性交由canonicalize_ip判断；
+# 只匹配以空白分隔的完整条目，条目可带 :端口 或 #标签 后缀，
+# CIDR网段、地址范围及夹杂其他字符的内容整体跳过
+_IP_RE = re.compile(rb'(?<!\S)((?:\d{1,3}\.){3}\d{1,3})(?::\d{1,5})?(?:#\S*)?(?!\S)')
 
 # 获取脚本所在目录的绝对路径
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+logger = logging.getLogger(__name__)
+
+# IP -> (国家代码, 查询时间)，只保存ip-api.com的在线查询结果，运行结束后保存到磁盘
+IP_COUNTRY_CACHE = {}
+# IP -> 国家代码，本地数据库的查询结果只在本次运行内复用，不写入磁盘，
+# 数据库更新后的修正可以立即生效
+DB_COUNTRY_CACHE = {}
+# 正在查询中的IP -> Future，并发查询同一个IP时共享一次查询结果
+IN_FLIGHT_LOOKUPS = {}
+CACHE_LOCK = threading.Lock()
+CACHE_PATH = os.path.join(SCRIPT_DIR, "data", "geo_cache.json")
+# 缓存有效期与数据库每周更新的频率一致
+CACHE_TTL = 7 * 24 * 3600
+# 查询失败（XX）的结果只缓存一天，之后重新查询
+NEGATIVE_CACHE_TTL = 24 * 3600
+# 共享线程池的线程数，用于域名解析、URL下载和国家代码查询
+MAX_WORKERS = 32
+# ip-api.com批量接口每次请求最多支持100个IP
+API_BATCH_SIZE = 100
+# 响应头显示剩余请求数低于该值时，暂停到窗口重置
+RATE_LIMIT_LOW_WATER = 5
+
+# 主数据库和备用数据库的下载地址
+DB_URL = "https://cdn.jsdelivr.net/gh/caaby/geoip@release/country.mmdb"
+SECONDARY_DB_URL = "https://github.com/P3TERX/GeoLite.mmdb/raw/download/GeoLite2-Country.mmdb"
+
+# 共享HTTP会话，复用连接，避免每次请求重新建立TCP连接
+SESSION = requests.Session()
+# http用于ip-api.com，https用于URL列表和数据库下载
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=0))
+SESSION.mount('https://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=0))
+SESSION.headers['User-Agent'] = 'ip-updater/1.0'
+
+def setup_logging():
+    """配置日志，工作线程只把日志放入队列，由后台线程统一输出，避免争抢stdout
+    
+    默认只输出汇总信息，设置 LOG_LEVEL=DEBUG 可查看每个IP的查询详情
+    """
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=getattr(logging, level, logging.INFO), format='%(message)s',
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    return listener
+
+class RateLimiter:
+    """滑动窗口限速器，保证任意period秒内最多发出n个请求，可被多个线程共享"""
+    
+    def __init__(self, n, period):
+        self.n = n
+        self.period = period
+        self.calls = collections.deque(maxlen=n)
+        self.lock = threading.Lock()
+        # 服务端提示额度将要用完时，在此时间之前暂停发出请求
+        self.paused_until = 0.0
+    
+    def acquire(self):
+        """等待直到允许发出下一个请求"""
+        with self.lock:
+            now = time.monotonic()
+            if self.paused_until > now:
+                time.sleep(self.paused_until - now)
+                now = time.monotonic()
+            if len(self.calls) == self.n and now - self.calls[0] < self.period:
+                time.sleep(self.period - (now - self.calls[0]))
+                now = time.monotonic()
+            self.calls.append(now)
+    
+    def observe(self, headers):
+        """根据ip-api.com返回的X-Rl（当前窗口剩余请求数）和X-Ttl（窗口重置剩余秒数），
+        在剩余额度过低时暂停后续请求直到窗口重置，避免触发429"""
+        try:
+            remaining = int(headers['X-Rl'])
+            ttl = int(headers['X-Ttl'])
+        except (KeyError, ValueError):
+            return
+        if remaining < RATE_LIMIT_LOW_WATER:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + ttl)
+    
+    def paused(self):
+        """是否处于服务端要求的暂停期内"""
+        return self.paused_until > time.monotonic()
+
+class BackpressureController:
+    """AIMD并发控制，限制同时进行中的在线查询数：请求成功时许可数加0.5，
+    被限流或超时时减半，可被多个线程共享"""
+    
+    def __init__(self, initial, minimum, maximum):
+        self.permits = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.cond = threading.Condition()
+    
+    def acquire(self):
+        """等待直到进行中的请求数低于当前许可数"""
+        with self.cond:
+            while self.active >= int(self.permits):
+                self.cond.wait()
+            self.active += 1
+    
+    def release(self, success):
+        """请求结束时归还许可，并按结果调整许可数"""
+        with self.cond:
+            self.active -= 1
+            if success:
+                self.permits = min(self.maximum, self.permits + 0.5)
+            else:
+                self.permits = max(self.minimum, self.permits // 2)
+            self.cond.notify_all()
+
+# ip-api.com免费接口限制：单个查询每分钟45次，批量查询每分钟15次
+API_RATE_LIMITER = RateLimiter(45, 60)
+BATCH_RATE_LIMITER = RateLimiter(15, 60)
+# 在线查询的并发数由AIMD动态调整，最少2个，最多不超过线程池大小
+ONLINE_CONCURRENCY = BackpressureController(8, 2, MAX_WORKERS)
+# 被限流（429）且限速器未暂停时的最大重试次数，以及指数退避的初始和单次最长等待秒数
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+def _retry_delay(attempt, headers):
+    """第attempt次重试前的等待秒数：指数退避乘以随机抖动，避免各线程同时醒来再次触发限流；
+    响应带有X-Ttl（窗口重置剩余秒数）时尽量等到窗口重置，但不超过RETRY_MAX_DELAY"""
+    delay = RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+    try:
+        delay = max(delay, int(headers.get('X-Ttl', 0)))
+    except ValueError:
+        pass
+    return min(RETRY_MAX_DELAY, delay)
+
+def _request_with_retry(limiter, method, url, **kwargs):
+    """经并发控制和限速器发出请求，返回最后一次的响应
+    
+    被限流时，若响应头已让限速器暂停到窗口重置，由限速器控制后续请求，不再重试；
+    否则（如响应缺少X-Rl/X-Ttl）退避后重试，最多MAX_RETRIES次
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        ONLINE_CONCURRENCY.acquire()
+        success = False
+        try:
+            limiter.acquire()
+            response = SESSION.request(method, url, **kwargs)
+            success = response.status_code != 429
+        finally:
+            # 超时等异常同样视为过载信号，减少并发
+            ONLINE_CONCURRENCY.release(success)
+        limiter.observe(response.headers)
+        if response.status_code != 429 or attempt == MAX_RETRIES or limiter.paused():
+            return response
+        delay = _retry_delay(attempt, response.headers)
+        logger.warning(f"[在线查询限流] {delay:.1f}秒后重试({attempt + 1}/{MAX_RETRIES})")
+        time.sleep(delay)
+
 def ensure_dir(directory):
     """确保目录存在，如果不存在则创建"""
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-def is_valid_ip(ip):
-    """验证IP地址格式是否有效"""
+def canonicalize_ip(ip):
+    """校验并规范化IP地址，返回不带方括号的标准形式，无效时返回None
+    
+    标准点分IPv4直接交给C实现的inet_aton校验；带前导零的IPv4去掉前导零，
+    任何一段大于255的地址都视为无效
+    """
     try:
-        # 移除IPv6的方括号
         ip = ip.strip('[]')
-        # 分割IP地址
-        parts = ip.split('.')
-        # 检查IPv4格式
-        if len(parts) != 4:
-            return False
-        # 检查每个部分是否在0-255范围内
-        return all(0 <= int(part) <= 255 for part in parts)
-    except (ValueError, AttributeError):
-        return False
-
-def download_mmdb():
-    """下载MaxMind GeoIP2数据库"""
+    except AttributeError:
+        return None
+    
+    # 常见情况：不含前导零的点分IPv4，校验通过即为标准形式
+    if _DOTTED_IPV4_RE.fullmatch(ip):
+        try:
+            socket.inet_aton(ip)
+            return ip
+        except OSError:
+            pass
+    
+    if ':' in ip:
+        try:
+            return str(ipaddress.IPv6Address(ip))
+        except ValueError:
+            return None
+    
+    # 少见情况：带前导零的IPv4
+    match = _LOOSE_IPV4_RE.fullmatch(ip)
+    if match is None:
+        return None
+    octets = [int(part) for part in match.groups()]
+    if any(octet > 255 for octet in octets):
+        return None
+    return '.'.join(map(str, octets))
+
+def ip_sort_key(ip):
+    """按数值排序IP使用的键，IPv4排在IPv6之前"""
+    if ':' in ip:
+        return 1, socket.inet_pton(socket.AF_INET6, ip.partition('%')[0])
+    return 0, socket.inet_aton(ip)
+
+class IPRecord(collections.namedtuple('IPRecord', 'canonical is_v6')):
+    """IP的规范形式及是否为IPv6，每个IP只构造一次，供后续查询和输出复用"""
+    __slots__ = ()
+    
+    @classmethod
+    def from_ip(cls, ip):
+        """由规范形式的IP（不带方括号）构造"""
+        return cls(ip, ':' in ip)
+    
+    @property
+    def host(self):
+        """输出用的地址，IPv6加方括号以便拼接端口"""
+        return f'[{self.canonical}]' if self.is_v6 else self.canonical
+
+def _fetch_mmdb(url, db_path, force=False):
+    """流式下载数据库到临时文件，校验可以打开后原子替换，避免留下写了一半或损坏的文件
+    
+    本地已有数据库且不是强制更新时，带上次的ETag/Last-Modified条件请求，服务端未更新时跳过下载
+    """
+    tmp_path = db_path + '.tmp'
+    meta_path = db_path + '.meta.json'
+    
+    headers = {}
+    if not force and os.path.exists(db_path) and os.path.getsize(db_path) > 0:
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        except (OSError, ValueError):
+            pass
+    
+    with SESSION.get(url, stream=True, timeout=30, headers=headers) as response:
+        if response.status_code == 304:
+            logger.info("数据库未更新，跳过下载")
+            return
+        response.raise_for_status()
+        # 服务器可能返回压缩内容，读取原始流时需要解压
+        response.raw.decode_content = True
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=1 << 20)
+        meta = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+    
+    # 下载内容无法作为数据库打开时丢弃，不替换现有文件，也不记录ETag
+    try:
+        maxminddb.open_database(tmp_path).close()
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, db_path)
+    
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def download_mmdb(url, filename, required=True):
+    """按更新策略下载GeoIP2数据库到data目录，返回数据库路径
+    
+    下载失败且没有可用的旧数据库时，required为True则退出，否则返回None
+    """
+    data_dir = os.path.join(SCRIPT_DIR, "data")
+    db_path = os.path.join(data_dir, filename)
     try:
-        data_dir = os.path.join(SCRIPT_DIR, "data")
         ensure_dir(data_dir)
-        db_path = os.path.join(data_dir, "country.mmdb")
         
-        # 如果文件不存在或强制更新，则下载
-        if not os.path.exists(db_path) or os.environ.get('FORCE_UPDATE') == 'true':
-            print("正在下载数据库...")
-            url = "https://cdn.jsdelivr.net/gh/caaby/geoip@release/country.mmdb"
-            response = requests.get(url)
-            
-            with open(db_path, "wb") as f:
-                f.write(response.content)
-                
-            print("GeoIP2数据库更新成功")
+        # 如果文件不存在、为空或强制更新，则下载
+        force = os.environ.get('FORCE_UPDATE') == 'true'
+        if not os.path.exists(db_path) or os.path.getsize(db_path) == 0 or force:
+            logger.info(f"正在下载数据库 {filename}...")
+            _fetch_mmdb(url, db_path, force)
+            logger.info(f"数据库 {filename} 已是最新")
         else:
             # 检查当前时间
             current_hour = datetime.datetime.now().hour
             if os.environ.get('GITHUB_ACTIONS') and current_hour != 10:  # 不是北京时间10点
-                print("不在数据库更新时间，跳过下载")
+                logger.info(f"不在数据库更新时间，跳过下载 {filename}")
             else:
-                print("正在更新数据库...")
-                url = "https://cdn.jsdelivr.net/gh/caaby/geoip@release/country.mmdb"
-                response = requests.get(url)
-                
-                with open(db_path, "wb") as f:
-                    f.write(response.content)
-                    
-                print("GeoIP2数据库更新成功")
+                logger.info(f"正在更新数据库 {filename}...")
+                _fetch_mmdb(url, db_path)
+                logger.info(f"数据库 {filename} 已是最新")
             
         return db_path
     except Exception as e:
-        print(f"下载GeoIP2数据库失败: {str(e)}")
-        sys.exit(1)
+        logger.error(f"下载数据库 {filename} 失败: {str(e)}")
+        # 已有可用的旧数据库时继续使用
+        if os.path.exists(db_path) and os.path.getsize(db_path) > 0:
+            logger.warning(f"继续使用现有数据库 {filename}")
+            return db_path
+        if required:
+            sys.exit(1)
+        return None
+
+def _warm_page_cache(db_path):
+    """预先把数据库文件读入系统页缓存，避免首批查询时逐页触发缺页中断"""
+    try:
+        with open(db_path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(1 << 20):
+                    pass
+    except OSError as e:
+        logger.warning(f"预读数据库文件失败: {str(e)}")
+
+def open_reader(db_path):
+    """打开GeoIP2数据库，优先使用C扩展的mmap模式，多个线程共享同一份映射"""
+    _warm_page_cache(db_path)
+    try:
+        return maxminddb.open_database(db_path, maxminddb.MODE_MMAP_EXT)
+    except ValueError as e:
+        logger.warning(f"警告：maxminddb C扩展不可用，使用纯Python模式查询，速度较慢: {str(e)}")
+        return maxminddb.open_database(db_path, maxminddb.MODE_MMAP)
+
+def _is_cache_fresh(country_code, timestamp):
+    """检查缓存记录是否仍在有效期内"""
+    ttl = NEGATIVE_CACHE_TTL if country_code == "XX" else CACHE_TTL
+    return time.time() - timestamp < ttl
+
+def _get_cached_country(ip):
+    """读取缓存的国家代码，不存在或已过期返回None"""
+    cached = IP_COUNTRY_CACHE.get(ip)
+    if cached and _is_cache_fresh(*cached):
+        return cached[0]
+    return None
+
+def _store_country(ip, country_code):
+    """写入在线查询结果的缓存"""
+    with CACHE_LOCK:
+        IP_COUNTRY_CACHE[ip] = (country_code, time.time())
+
+def load_cache():
+    """从磁盘加载上次运行保存的国家代码缓存，丢弃已过期的记录"""
+    try:
+        with open(CACHE_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.error(f"读取缓存文件失败: {str(e)}")
+        return
+    if not isinstance(data, dict):
+        logger.error("读取缓存文件失败: 格式错误")
+        return
+    
+    for ip, entry in data.items():
+        try:
+            country_code, timestamp = entry
+            if _is_cache_fresh(country_code, timestamp):
+                IP_COUNTRY_CACHE[ip] = (country_code, timestamp)
+        except (TypeError, ValueError):
+            logger.warning(f"跳过格式错误的缓存记录: {ip}")
+    logger.info(f"已加载 {len(IP_COUNTRY_CACHE)} 条缓存记录")
+
+def save_cache():
+    """保存国家代码缓存到磁盘，先写临时文件再原子替换"""
+    try:
+        ensure_dir(os.path.dirname(CACHE_PATH))
+        tmp_path = CACHE_PATH + '.tmp'
+        with CACHE_LOCK:
+            data = dict(IP_COUNTRY_CACHE)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except Exception as e:
+        logger.error(f"保存缓存文件失败: {str(e)}")
 
-def get_country_code(ip, reader):
-    """查询IP所属国家代码，先用数据库，失败后用ip-api.com"""
-    # 首先尝试使用GeoIP2数据库
+def _claim_lookups(ips):
+    """为尚未缓存且无人查询的IP登记Future，返回由调用方负责查询的 {IP: Future}"""
+    claimed = {}
+    with CACHE_LOCK:
+        for ip in ips:
+            if _get_cached_country(ip) is None and ip not in IN_FLIGHT_LOOKUPS:
+                claimed[ip] = IN_FLIGHT_LOOKUPS[ip] = concurrent.futures.Future()
+    return claimed
+
+def _batch_lookup_task(claimed):
+    """批量在线查询已登记的IP，并唤醒等待这些IP的线程
+    
+    批量查询未返回的IP结果为None，等待方会自行逐个兜底查询
+    """
+    country_codes = {}
+    try:
+        country_codes = geo_lookup_batch(list(claimed))
+    finally:
+        for ip, future in claimed.items():
+            country_code = country_codes.get(ip)
+            if country_code is not None:
+                _store_country(ip, country_code)
+            with CACHE_LOCK:
+                del IN_FLIGHT_LOOKUPS[ip]
+            future.set_result(country_code)
+
+def get_country_code(ip, readers, online=True):
+    """查询IP所属国家代码，本地数据库优先，未收录时使用在线查询缓存和ip-api.com
+    
+    online为False或IP不是公网地址时不进行在线查询，未查到返回None
+    """
+    with CACHE_LOCK:
+        country_code = DB_COUNTRY_CACHE.get(ip)
+    if country_code:
+        return country_code
+    
+    # 本地数据库查询只需几微秒，不需要持久化缓存，也无需与其他线程合并
+    country_code = _lookup_db(ip, readers)
+    if country_code:
+        with CACHE_LOCK:
+            DB_COUNTRY_CACHE[ip] = country_code
+        return country_code
+    
+    while True:
+        with CACHE_LOCK:
+            country_code = _get_cached_country(ip)
+            if country_code:
+                return country_code
+            
+            # 已有线程在查询同一个IP时等待其结果，否则由当前线程负责查询
+            future = IN_FLIGHT_LOOKUPS.get(ip)
+            if future is None:
+                if not online or not _is_public_ip(ip):
+                    return None
+                future = IN_FLIGHT_LOOKUPS[ip] = concurrent.futures.Future()
+                break
+        
+        country_code = future.result()
+        # 对方的在线查询失败而当前需要时，重新尝试
+        if country_code is not None or not online:
+            return country_code
+    
+    country_code = None
     try:
-        response = reader.country(ip)
-        country_code = response.country.iso_code
+        country_code = _lookup_online(ip)
+        if country_code is not None:
+            _store_country(ip, country_code)
+        return country_code
+    finally:
+        with CACHE_LOCK:
+            del IN_FLIGHT_LOOKUPS[ip]
+        future.set_result(country_code)
+
+def _is_public_ip(ip):
+    """是否为公网地址，内网、保留、回环等地址ip-api.com也只会返回失败，无需在线查询"""
+    return ipaddress.ip_address(ip).is_global
+
+def _lookup_db(ip, readers):
+    """依次使用各个本地数据库查询国家代码，均未找到返回None
+    
+    数据库中没有国家信息时（如任播地址），使用注册国家代替
+    """
+    for reader in readers:
+        try:
+            record = reader.get(ip)
+        except Exception as e:
+            logger.warning(f"[数据库查询失败] IP: {ip} 错误信息: {str(e)}")
+            continue
+        if not record:
+            continue
+        
+        # 直接读取原始记录中的iso_code，不构造完整的geoip2模型对象
+        country = record.get('country') or record.get('registered_country') or {}
+        country_code = country.get('iso_code')
         if country_code:
-            print(f"[数据库查询成功] IP: {ip} 国家代码: {country_code}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"[数据库查询成功] IP: {ip} 国家代码: {country_code}")
             return country_code
-    except Exception as e:
-        print(f"[数据库查询失败] IP: {ip} 错误信息: {str(e)}")
     
-    # 数据库查询失败，尝试使用ip-api.com
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[数据库查询失败] IP: {ip} 数据库中未收录")
+    return None
+
+def _lookup_online(ip):
+    """使用ip-api.com查询单个IP的国家代码，仅作为批量查询失败后的兜底"""
     try:
-        print(f"[尝试在线查询] IP: {ip}")
-        response = requests.get(f"http://ip-api.com/json/{ip}", timeout=3)
-        data = response.json()
+        logger.debug(f"[尝试在线查询] IP: {ip}")
+        response = _request_with_retry(API_RATE_LIMITER, "GET", f"http://ip-api.com/json/{ip}", timeout=3)
+        if response.status_code == 429:
+            # 限流不代表IP无效，不缓存结果，下次运行重新查询
+            logger.warning(f"[在线查询失败] IP: {ip} 被限流")
+            return None
+        data = orjson.loads(response.content)
         
         if data.get("status") == "success":
             country_code = data.get("countryCode", "XX")
-            print(f"[在线查询成功] IP: {ip} 国家代码: {country_code}")
+            logger.debug(f"[在线查询成功] IP: {ip} 国家代码: {country_code}")
             return country_code
         else:
-            print(f"[在线查询失败] IP: {ip} 错误信息: {data.get('message', '未知错误')}")
+            logger.warning(f"[在线查询失败] IP: {ip} 错误信息: {data.get('message', '未知错误')}")
             return "XX"
             
     except requests.exceptions.Timeout:
-        print(f"[在线查询超时] IP: {ip}")
+        logger.warning(f"[在线查询超时] IP: {ip}")
+        return "XX"
+    except orjson.JSONDecodeError as e:
+        logger.warning(f"[在线查询错误] IP: {ip} 返回内容无法解析: {str(e)}")
         return "XX"
     except Exception as e:
-        print(f"[在线查询错误] IP: {ip} 错误信息: {str(e)}")
+        logger.warning(f"[在线查询错误] IP: {ip} 错误信息: {str(e)}")
         return "XX"
 
-def resolve_domain(reader):
-    """解析域名获取IP"""
+def geo_lookup_batch(ips):
+    """使用ip-api.com批量接口查询国家代码，每次最多100个IP
+    
+    返回 {IP: 国家代码}，请求失败时返回空字典，由调用方逐个兜底查询
+    """
     try:
-        # 检查必需的环境变量
-        if 'TARGET_DOMAIN' not in os.environ:
-            print('错误：未设置 TARGET_DOMAIN 环境变量')
-            return []
-            
-        domains = os.environ['TARGET_DOMAIN'].split(',')
-        domains = [domain.strip() for domain in domains if domain.strip()]
+        logger.info(f"[批量在线查询] 查询 {len(ips)} 个IP")
+        response = _request_with_retry(
+            BATCH_RATE_LIMITER, "POST",
+            "http://ip-api.com/batch",
+            params={"fields": "status,countryCode,query"},
+            json=[{"query": ip} for ip in ips[:API_BATCH_SIZE]],
+            timeout=10,
+        )
+        response.raise_for_status()
         
-        if not domains:
-            print('错误：TARGET_DOMAIN 环境变量为空')
-            return []
+        country_codes = {}
+        for data in orjson.loads(response.content):
+            if data.get("status") == "success":
+                country_codes[data["query"]] = data.get("countryCode", "XX")
+            else:
+                country_codes[data.get("query")] = "XX"
+        return country_codes
         
-        ports = os.environ.get('TARGET_PORTS', '443').split(',')
-        ports = [port.strip() for port in ports if port.strip().isdigit()]
+    except Exception as e:
+        logger.warning(f"[批量在线查询失败] 错误信息: {str(e)}")
+        return {}
+
+@dataclass(frozen=True)
+class Config:
+    """运行配置，启动时从环境变量解析一次"""
+    domains: tuple[str, ...]
+    urls: tuple[str, ...]
+    ports: tuple[str, ...]
+    online_fallback: bool = False
+    
+    @classmethod
+    def from_env(cls):
+        """从环境变量构造配置，TARGET_PORTS未设置或无效时使用默认端口443"""
+        domains = tuple(d.strip() for d in os.environ.get('TARGET_DOMAIN', '').split(',') if d.strip())
+        urls = tuple(u.strip() for u in os.environ.get('TARGET_URLS', '').split(',') if u.strip())
+        ports = tuple(p.strip() for p in os.environ.get('TARGET_PORTS', '443').split(',') if p.strip().isdigit())
         
         if not ports:
-            print('警告：未设置有效的 TARGET_PORTS 环境变量，使用默认端口443')
-            ports = ['443']
+            logger.warning('警告：未设置有效的 TARGET_PORTS 环境变量，使用默认端口443')
+            ports = ('443',)
         
-        results = []
-        country_results = {}  # 使用字典存储不同国家的结果
+        online_fallback = os.environ.get('ENABLE_ONLINE_FALLBACK', '').lower() in ('true', '1')
+        return cls(domains, urls, ports, online_fallback)
+
+def resolve_domain(cfg, executor):
+    """解析域名获取IP集合"""
+    all_ips = set()
+    try:
+        # 检查必需的环境变量
+        if not cfg.domains:
+            logger.error('错误：TARGET_DOMAIN 环境变量未设置或为空')
+            return all_ips
+        
+        # 并发解析所有域名
+        futures = {}
+        for domain in cfg.domains:
+            logger.info(f"\n[域名解析] 正在解析域名: {domain}")
+            # 只请求TCP记录，避免同一个IP按UDP/RAW重复返回
+            future = executor.submit(socket.getaddrinfo, domain, None, socket.AF_UNSPEC,
+                                     socket.SOCK_STREAM, socket.IPPROTO_TCP)
+            futures[future] = domain
         
-        # 处理每个域名
-        for domain in domains:
+        for future in concurrent.futures.as_completed(futures):
+            domain = futures[future]
             try:
-                print(f"\n[域名解析] 正在解析域名: {domain}")
-                addrinfo = socket.getaddrinfo(domain, None)
-                all_ips = set()
-                
-                for addr in addrinfo:
-                    ip = addr[4][0]
-                    if ':' in ip:
-                        all_ips.add(f'[{ip}]')
-                    else:
-                        all_ips.add(ip)
-                
-                for ip in sorted(all_ips):
-                    country_code = get_country_code(ip.strip('[]'), reader)
-                    for port in ports:
-                        result = f'{ip}:{port}#{country_code}'
-                        results.append(result)
-                        print(f"[域名解析] {result}")
-                        
-                        # 将结果添加到对应国家的列表中
-                        if country_code not in country_results:
-                            country_results[country_code] = []
-                        country_results[country_code].append(result)
-                        
+                addrinfo = future.result()
             except socket.gaierror as e:
-                print(f'DNS解析错误 {domain}: {str(e)}')
+                logger.error(f'DNS解析错误 {domain}: {str(e)}')
                 continue
             except Exception as e:
-                print(f'域名解析发生错误 {domain}: {str(e)}')
+                logger.error(f'域名解析发生错误 {domain}: {str(e)}')
                 continue
-        
-        # 确保ip目录存在
-        ip_dir = os.path.join(SCRIPT_DIR, "ip")
-        ensure_dir(ip_dir)
-        
-        # 为每个国家创建单独的文件
-        for country_code, country_ips in country_results.items():
-            if country_code == "XX":  # 跳过未知国家
-                continue
-                
-            filename = os.path.join(ip_dir, f'{country_code.lower()}.txt')
-            with open(filename, 'a', encoding='utf-8') as f:  # 使用追加模式
-                for result in country_ips:
-                    f.write(f'{result}\n')
-            print(f"\n[域名解析] 发现 {len(country_ips)} 个 {country_code} 地址，已保存到 {filename}")
-                
-        return results
+            
+            domain_ips = {addr[4][0] for addr in addrinfo}
+            logger.info(f"[域名解析] {domain} 解析到 {len(domain_ips)} 个IP")
+            all_ips.update(domain_ips)
+            
+        return all_ips
             
     except Exception as e:
-        print(f'域名解析发生错误: {str(e)}')
-        return []
+        logger.error(f'域名解析发生错误: {str(e)}')
+        return all_ips
+
+def _fetch_url(url):
+    """下载单个URL的内容，返回未解码的原始字节"""
+    logger.info(f"\n[URL读取] 正在从 {url} 获取IP列表...")
+    response = SESSION.get(url, timeout=10)  # 添加超时设置
+    response.raise_for_status()
+    return response.content
 
-def read_ip_from_url(reader):
-    """从多个URL读取IP列表并查询国家代码"""
+def read_ip_from_url(cfg, executor):
+    """从多个URL读取IP集合"""
+    all_ips = set()
     try:
-        # 获取URL列表
-        if 'TARGET_URLS' not in os.environ:
-            print('错误：未设置 TARGET_URLS 环境变量')
-            return []
-            
-        urls = os.environ['TARGET_URLS'].split(',')
-        urls = [url.strip() for url in urls if url.strip()]
+        # 检查URL列表
+        if not cfg.urls:
+            logger.error('错误：TARGET_URLS 环境变量未设置或为空')
+            return all_ips
         
-        if not urls:
-            print('错误：TARGET_URLS 环境变量为空')
-            return []
+        # 并发下载所有URL，下载完成后依次解析
+        futures = {executor.submit(_fetch_url, url): url for url in cfg.urls}
         
-        results = []
-        country_results = {}  # 使用字典存储不同国家的结果
-        
-        # 获取端口列表，如果环境变量未设置则使用默认端口443
-        ports = os.environ.get('TARGET_PORTS', '443').split(',')
-        ports = [port.strip() for port in ports if port.strip().isdigit()]
-        if not ports:
-            print('警告：未设置有效的 TARGET_PORTS 环境变量，使用默认端口443')
-            ports = ['443']
-        
-        # 处理每个URL
-        for url in urls:
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
             try:
-                print(f"\n[URL读取] 正在从 {url} 获取IP列表...")
-                response = requests.get(url, timeout=10)  # 添加超时设置
-                response.raise_for_status()
-                
-                ip_list = response.text.strip().split()
+                # 直接在原始字节上用正则提取IP并去重，验证和规范化一遍完成，无效IP不会进入集合
+                candidates = {m.decode('ascii') for m in _IP_RE.findall(future.result())}
+                url_ips = set(filter(None, map(canonicalize_ip, candidates)))
+                logger.info(f"[URL读取] {url} 获取到 {len(url_ips)} 个有效IP")
+                all_ips.update(url_ips)
                 
-                for ip in ip_list:
-                    ip = ip.strip()
-                    if not ip:
-                        continue
-                        
-                    # 添加IP验证
-                    if not is_valid_ip(ip):
-                        print(f"[URL读取] 跳过无效IP: {ip}")
-                        continue
-                        
-                    country_code = get_country_code(ip, reader)
-                    # 为每个端口生成一个结果
-                    for port in ports:
-                        result = f'{ip}:{port}#{country_code}'
-                        results.append(result)
-                        print(f"[URL读取] {result}")
-                        
-                        # 将结果添加到对应国家的列表中
-                        if country_code not in country_results:
-                            country_results[country_code] = []
-                        country_results[country_code].append(result)
-                        
             except requests.RequestException as e:
-                print(f'获取URL {url} 失败: {str(e)}')
+                logger.error(f'获取URL {url} 失败: {str(e)}')
                 continue
             except Exception as e:
-                print(f'处理URL {url} 时发生错误: {str(e)}')
-                continue
-        
-        # 确保ip目录存在
-        ip_dir = os.path.join(SCRIPT_DIR, "ip")
-        ensure_dir(ip_dir)
-        
-        # 为每个国家创建单独的文件
-        for country_code, country_ips in country_results.items():
-            if country_code == "XX":  # 跳过未知国家
+                logger.error(f'处理URL {url} 时发生错误: {str(e)}')
                 continue
-                
-            filename = os.path.join(ip_dir, f'{country_code.lower()}.txt')
-            with open(filename, 'w', encoding='utf-8') as f:
-                for result in country_ips:
-                    f.write(f'{result}\n')
-            print(f"\n[URL读取] 发现 {len(country_ips)} 个 {country_code} 地址，已保存到 {filename}")
-                
-        return results
+            
+        return all_ips
             
     except Exception as e:
-        print(f'URL读取发生错误: {str(e)}')
-        return []
+        logger.error(f'URL读取发生错误: {str(e)}')
+        return all_ips
+
+def process_single_ip(record, readers, port_suffixes, online):
+    """查询单个IP的国家代码，并为每个端口生成一个结果，port_suffixes形如[':443', ...]
+    
+    未开启在线查询时，本地数据库未收录的IP标记为XX
+    """
+    country_code = get_country_code(record.canonical, readers, online) or "XX"
+    host = record.host
+    return country_code, [f'{host}{suffix}#{country_code}' for suffix in port_suffixes]
+
+def batch_process_ips(ip_list, readers, cfg, executor):
+    """并发查询IP集合（规范形式）的国家代码，返回全部结果和按国家分组的结果
+    
+    查询按任意顺序提交，只在汇总输出时按IP数值排序一次
+    """
+    results = []
+    country_results = {}  # 使用字典存储不同国家的结果
+    records = [IPRecord.from_ip(ip) for ip in ip_list]
+    
+    # 先查询数据库，开启在线查询时未命中的公网IP登记为查询中，按每批100个提交批量查询。
+    # 批量任务先于逐个查询任务提交，线程池按顺序执行，因此等待批量结果的
+    # process_single_ip不会占满线程导致批量任务无法运行；批量查询失败的IP由其逐个兜底查询
+    if cfg.online_fallback:
+        misses = [r.canonical for r in records
+                  if get_country_code(r.canonical, readers, online=False) is None and _is_public_ip(r.canonical)]
+        claimed = list(_claim_lookups(misses).items())
+        for i in range(0, len(claimed), API_BATCH_SIZE):
+            executor.submit(_batch_lookup_task, dict(claimed[i:i + API_BATCH_SIZE]))
+    
+    port_suffixes = [f':{port}' for port in cfg.ports]
+    futures = [executor.submit(process_single_ip, record, readers, port_suffixes, cfg.online_fallback)
+               for record in records]
+    
+    # 按IP数值顺序汇总结果，保证输出顺序稳定
+    ordered = sorted(zip(records, futures), key=lambda pair: ip_sort_key(pair[0].canonical))
+    for record, future in ordered:
+        ip = record.canonical
+        try:
+            country_code, ip_results = future.result()
+        except Exception as e:
+            logger.error(f'查询国家代码发生错误 {ip}: {str(e)}')
+            continue
+        
+        results.extend(ip_results)
+        # 将结果添加到对应国家的列表中
+        country_results.setdefault(country_code, []).extend(ip_results)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[IP查询] {ip}#{country_code} 已添加 {len(ip_results)} 个端口")
+    
+    logger.info(f"[IP查询] 已完成 {len(ip_list)} 个IP的查询，共生成 {len(results)} 条结果")
+            
+    return results, country_results
+
+def save_results(country_results):
+    """为每个国家创建单独的文件"""
+    # 确保ip目录存在
+    ip_dir = os.path.join(SCRIPT_DIR, "ip")
+    ensure_dir(ip_dir)
+    
+    for country_code, country_ips in country_results.items():
+        if country_code == "XX":  # 跳过未知国家
+            continue
+            
+        filename = os.path.join(ip_dir, f'{country_code.lower()}.txt')
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(country_ips) + '\n')
+        logger.info(f"\n[IP查询] 发现 {len(country_ips)} 个 {country_code} 地址，已保存到 {filename}")
 
 def main():
     """主函数，自动检测条件并执行"""
-    print("正在初始化...")
+    logger.info("正在初始化...")
     
-    # 加载环境变量
-    if not os.environ.get('GITHUB_ACTIONS'):
-        load_dotenv()
+    cfg = Config.from_env()
     
     # 检查条件
-    has_domain = 'TARGET_DOMAIN' in os.environ
-    
-    # 严格检查环境变量
-    if has_domain and 'TARGET_DOMAIN' not in os.environ:
-        print('错误：未设置 TARGET_DOMAIN 环境变量')
-        has_domain = False
+    has_domain = bool(cfg.domains)
     
     if not has_domain:
-        print("提示：未设置域名环境变量，将只从GitHub获取IP列表")
-    
-    # 准备GeoIP2数据库
-    db_path = os.path.join(SCRIPT_DIR, "data", "country.mmdb")
-    if not os.path.exists(db_path):
-        print("数据库文件不存在，正在下载...")
-        db_path = download_mmdb()
-    else:
-        # 检查文件大小确保不是空文件
-        if os.path.getsize(db_path) == 0:
-            print("数据库文件损坏，重新下载...")
-            db_path = download_mmdb()
-    
-    reader = geoip2.database.Reader(db_path)
-    all_results = []
+        logger.info("提示：未设置域名环境变量，将只从GitHub获取IP列表")
+    
+    # 准备GeoIP2数据库，文件缺失或损坏时下载，否则按更新策略条件请求
+    db_path = download_mmdb(DB_URL, "country.mmdb")
+    
+    # 备用数据库用于补充主数据库未收录的IP
+    # 与主数据库使用相同的更新策略，下载失败且本地没有时不影响主流程
+    secondary_path = download_mmdb(SECONDARY_DB_URL, "GeoLite2-Country.mmdb", required=False)
+    
+    load_cache()
+    readers = []
+    # 整个运行过程共用一个线程池，避免反复创建和销毁线程
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
     
     try:
+        readers.append(open_reader(db_path))
+        if secondary_path:
+            try:
+                readers.append(open_reader(secondary_path))
+            except (maxminddb.InvalidDatabaseError, OSError) as e:
+                logger.warning(f"打开备用数据库失败，只使用主数据库: {str(e)}")
+        
         # 确保ip目录存在
         ip_dir = os.path.join(SCRIPT_DIR, "ip")
         ensure_dir(ip_dir)
         
-        # 执行域名解析
-        if has_domain:
-            if 'TARGET_DOMAIN' not in os.environ:
-                print('错误：未设置 TARGET_DOMAIN 环境变量')
-            else:
-                domain_results = resolve_domain(reader)
-                all_results.extend(domain_results)
+        # 汇总域名解析和URL读取的IP，去重后统一查询
+        all_ips = set()
+        
+        # 域名解析在线程池中进行，同时在主线程读取GitHub上的IP列表，两个阶段的等待相互重叠
+        dns_future = executor.submit(resolve_domain, cfg, executor) if has_domain else None
         
         # 从GitHub读取IP列表
-        url_results = read_ip_from_url(reader)
-        all_results.extend(url_results)
+        all_ips.update(read_ip_from_url(cfg, executor))
+        
+        if dns_future is not None:
+            all_ips.update(dns_future.result())
+        
+        logger.info(f"\n[IP查询] 共 {len(all_ips)} 个不重复IP，开始查询国家代码...")
+        all_results, country_results = batch_process_ips(all_ips, readers, cfg, executor)
+        save_results(country_results)
         
         # 保存所有结果到ip.txt
         if all_results:
             with open(os.path.join(ip_dir, 'ip.txt'), 'w', encoding='utf-8') as f:
-                for result in all_results:
-                    f.write(f'{result}\n')
+                f.write('\n'.join(all_results) + '\n')
         
     finally:
-        reader.close()
+        executor.shutdown()
+        for reader in readers:
+            reader.close()
+        save_cache()
     
-    print("\n处理完成！")
-    print(f"所有结果已保存到 ip/ip.txt")
+    logger.info("\n处理完成！")
+    logger.info(f"所有结果已保存到 ip/ip.txt")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # 加载环境变量，需在配置日志之前，使.env中的LOG_LEVEL生效
+    if not os.environ.get('GITHUB_ACTIONS'):
+        load_dotenv()
+    listener = setup_logging()
+    try:
+        main()
+    finally:
+        listener.stop()
\ No newline at end of file